@@ -1,50 +1,97 @@
-import markdown
-import weasyprint
 import yaml
 import os
-import glob
+import re
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import html
 from datetime import datetime
 
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 def load_invoice_data(yaml_file):
-    """Load invoice data from a YAML file."""
-    with open(yaml_file, 'r') as file:
-        return yaml.safe_load(file)
+    """Load invoice data from a YAML file, along with a hash of its contents."""
+    with open(yaml_file, 'rb') as file:
+        raw = file.read()
+    return yaml.load(raw, Loader=YamlLoader), hashlib.blake2b(raw).hexdigest()
 
 def load_css(css_file="includes/style.css"):
     """Load CSS from external file."""
     try:
-        with open(css_file, 'r') as file:
-            return f"<style>\n{file.read()}\n</style>"
+        with open(css_file, 'rb') as file:
+            return file.read().decode('utf-8')
     except FileNotFoundError:
         print(f"Warning: CSS file {css_file} not found. Using minimal styling.")
-        return "<style>body { font-family: Arial, sans-serif; margin: 40px; }</style>"
+        return "body { font-family: Arial, sans-serif; margin: 40px; }"
+
+# The HTML backend (markdown-it-py + WeasyPrint) is imported lazily, like
+# ReportLab, so each run only loads the renderer it actually uses
+@functools.lru_cache(maxsize=1)
+def get_markdown_renderer():
+    """Build the Markdown renderer (CommonMark plus GFM tables), once per process."""
+    from markdown_it import MarkdownIt
+    return MarkdownIt("commonmark").enable("table")
+
+@functools.lru_cache(maxsize=4)
+def get_stylesheet(css):
+    """Parse CSS into a WeasyPrint stylesheet, once per process."""
+    import weasyprint
+    from weasyprint.text.fonts import FontConfiguration
+    
+    font_config = FontConfiguration()
+    return weasyprint.CSS(string=css, font_config=font_config), font_config
 
 def get_invoice_files():
     """Get all invoice YAML files except the template."""
-    invoice_files = glob.glob("invoices/*.yaml")
-    # Filter out the template file
-    return [f for f in invoice_files if not os.path.basename(f).startswith('_')]
+    with os.scandir("invoices") as entries:
+        # Skip the template file (and anything else prefixed with an underscore)
+        return [entry.path for entry in entries
+                if entry.is_file() and entry.name.endswith(".yaml") and not entry.name.startswith('_')]
 
-def check_existing_pdf(invoice_number, output_dir="output", force_regenerate=False):
-    """Check if a PDF for this invoice already exists."""
-    if force_regenerate:
-        return False  # Always generate if force_regenerate is True
+def get_existing_pdfs(output_dir="output"):
+    """Map each invoice number to the (date stamp, path) of its generated PDFs."""
+    existing_pdfs = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            m = re.match(r"invoice_(.+?)_(\d+)\.pdf$", entry.name)
+            if m:
+                existing_pdfs.setdefault(m.group(1), []).append((int(m.group(2)), entry.path))
+    return existing_pdfs
+
+def check_existing_pdf(invoice_number, existing_pdfs, content_hash):
+    """Check if an up-to-date PDF for this invoice already exists.
     
-    pattern = os.path.join(output_dir, f"invoice_{invoice_number}_*.pdf")
-    existing_pdfs = glob.glob(pattern)
-    return len(existing_pdfs) > 0
+    Each PDF has a .blake2b sidecar holding the hash of the YAML it was built
+    from. Only the newest PDF (latest date stamp) counts, so reverting an edit
+    doesn't match an older PDF. A newest PDF without a sidecar (generated
+    before hashes were recorded) is treated as up to date.
+    """
+    pdf_files = existing_pdfs.get(str(invoice_number))
+    if not pdf_files:
+        return False
+    _, newest_pdf = max(pdf_files)
+    try:
+        with open(f"{newest_pdf}.blake2b", 'r') as file:
+            return file.read().strip() == content_hash
+    except FileNotFoundError:
+        return True
 
 # Markdown template for the invoice
 def create_markdown_invoice(data):
-    total_hours = sum(item["hours"] for item in data["services"])
+    services = data["services"]
     
     # Build the "To" section with optional email
     to_section = f"{data['to_name']}"
-    if data.get("to_email") and data["to_email"].strip():
-        to_section += f"  \nEmail: `{data['to_email']}`"
+    to_email = data.get("to_email")
+    if to_email and to_email.strip():
+        to_section += f"  \nEmail: `{to_email}`"
     
-    markdown_content = f"""
+    parts = [f"""
 # INVOICE
 
 **Invoice Number:** {data["invoice_number"]}  
@@ -63,11 +110,15 @@ For professional services rendered:
 
 | Description                  | Hours | Rate    | Amount    |
 |------------------------------|-------|---------|-----------|
-"""
-    for service in data["services"]:
-        markdown_content += f"| {service['description']:<28} | {service['hours']:>5.1f} | ${service['rate']:>6.2f}/hr | ${service['amount']:>8.2f} |\n"
+"""]
+    # Total the hours in the same pass that formats the rows
+    total_hours = 0.0
+    for service in services:
+        hours = service["hours"]
+        total_hours += hours
+        parts.append(f"| {service['description']:<28} | {hours:>5.1f} | ${service['rate']:>6.2f}/hr | ${service['amount']:>8.2f} |\n")
 
-    markdown_content += f"""
+    parts.append(f"""
 **Total Hours:** {total_hours:.1f}  
 **Total Amount Due:** ${data["total_amount"]:,.2f}
 
@@ -76,34 +127,152 @@ For professional services rendered:
 
 ## Terms
 {data["terms"]}
-"""
-    return markdown_content
+""")
+    return "".join(parts)
 
 # Generate the PDF
-def generate_pdf(markdown_content, output_filename, debug_mode=False):
-    """Generate PDF from markdown content."""
-    # Ensure output directory exists
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-    
-    # Load CSS from external file
-    css = load_css()
+def generate_pdf(markdown_content, output_filename, css, debug_mode=False):
+    """Generate PDF from markdown content (the output directory must already exist)."""
+    import weasyprint
     
     # Convert Markdown to HTML
-    html_content = markdown.markdown(markdown_content, extensions=['tables'])
-    # Combine HTML with CSS
-    full_html = f"<html><head>{css}</head><body>{html_content}</body></html>"
+    html_content = get_markdown_renderer().render(markdown_content)
     
-    # Save HTML for debugging if requested
+    # Save HTML (with CSS inlined) for debugging if requested
     if debug_mode:
+        full_html = f"<html><head><style>\n{css}\n</style></head><body>{html_content}</body></html>"
         debug_filename = "debug.html"
         with open(debug_filename, 'w', encoding='utf-8') as f:
             f.write(full_html)
         print(f"Debug HTML saved: {debug_filename}")
     
-    # Generate PDF using WeasyPrint
-    weasyprint.HTML(string=full_html).write_pdf(output_filename)
+    # Generate PDF using WeasyPrint with the pre-parsed stylesheet. The HTML5
+    # parser supplies <html>/<body> itself, so the fragment is passed as-is.
+    stylesheet, font_config = get_stylesheet(css)
+    # Lay out the document before opening the file, so a render error
+    # doesn't leave an empty PDF behind
+    document = weasyprint.HTML(string=html_content).render(
+        stylesheets=[stylesheet], font_config=font_config)
+    with open(output_filename, 'wb') as f:
+        document.write_pdf(target=f)
+    print(f"PDF generated: {output_filename}")
+
+@functools.lru_cache(maxsize=1)
+def get_reportlab_styles():
+    """Build the ReportLab paragraph and table styles, once per process."""
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.platypus import TableStyle
+
+    base = getSampleStyleSheet()
+    blue = colors.HexColor("#168FD8")
+    return {
+        "title": ParagraphStyle("InvoiceTitle", parent=base["Title"], alignment=TA_CENTER,
+                                textColor=blue, spaceAfter=20),
+        "heading": ParagraphStyle("InvoiceHeading", parent=base["Heading2"],
+                                  textColor=colors.HexColor("#E25041"), spaceBefore=14, spaceAfter=6),
+        "body": ParagraphStyle("InvoiceBody", parent=base["BodyText"], fontSize=11, leading=16),
+        "table": TableStyle([
+            ("BACKGROUND", (0, 0), (-1, 0), blue),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#FEFEFE")),
+            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+            ("GRID", (0, 0), (-1, -1), 1, blue),
+            ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#F8F9FA")]),
+            ("TOPPADDING", (0, 0), (-1, -1), 6),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ]),
+    }
+
+def to_reportlab_markup(text):
+    """Escape free text for a ReportLab Paragraph, keeping line breaks and `code` spans."""
+    markup = html.escape(str(text).strip(), quote=False)
+    markup = re.sub(r"`([^`]*)`", r'<font name="Courier">\1</font>', markup)
+    return markup.replace("\n", "<br/>")
+
+def render_invoice_pdf(data, output_filename):
+    """Generate the invoice PDF directly with ReportLab, bypassing HTML/CSS."""
+    from reportlab.lib.pagesizes import LETTER
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Table
+
+    styles = get_reportlab_styles()
+    body, heading = styles["body"], styles["heading"]
+
+    to_lines = [to_reportlab_markup(data["to_name"])]
+    to_email = data.get("to_email")
+    if to_email and to_email.strip():
+        to_lines.append("Email: " + to_reportlab_markup(f"`{to_email}`"))
+
+    from_email = to_reportlab_markup(f"`{data['from_email']}`")
+
+    rows = [["Description", "Hours", "Rate", "Amount"]]
+    total_hours = 0.0
+    for service in data["services"]:
+        total_hours += service["hours"]
+        rows.append([Paragraph(to_reportlab_markup(service["description"]), body),
+                     f"{service['hours']:.1f}", f"${service['rate']:.2f}/hr", f"${service['amount']:.2f}"])
+    services_table = Table(rows, colWidths=[3.5 * inch, 0.8 * inch, 1.2 * inch, 1.3 * inch], repeatRows=1)
+    services_table.setStyle(styles["table"])
+
+    story = [
+        Paragraph("INVOICE", styles["title"]),
+        Paragraph(f"<b>Invoice Number:</b> {to_reportlab_markup(data['invoice_number'])}<br/>"
+                  f"<b>Invoice Date:</b> {to_reportlab_markup(data['invoice_date'])}<br/>"
+                  f"<b>Due Date:</b> {to_reportlab_markup(data['due_date'])}", body),
+        Paragraph("From", heading),
+        Paragraph(f"{to_reportlab_markup(data['from_name'])}<br/>"
+                  f"Email: {from_email}", body),
+        Paragraph("To", heading),
+        Paragraph("<br/>".join(to_lines), body),
+        Paragraph("Description of Services", heading),
+        Paragraph("For professional services rendered:", body),
+        services_table,
+        Paragraph(f"<b>Total Hours:</b> {total_hours:.1f}<br/>"
+                  f"<b>Total Amount Due:</b> ${data['total_amount']:,.2f}", body),
+        Paragraph("Payment Instructions", heading),
+        Paragraph(to_reportlab_markup(data["payment_instructions"]), body),
+        Paragraph("Terms", heading),
+        Paragraph(to_reportlab_markup(data["terms"]), body),
+    ]
+    doc = SimpleDocTemplate(output_filename, pagesize=LETTER, title=f"Invoice {data['invoice_number']}",
+                            leftMargin=0.75 * inch, rightMargin=0.75 * inch,
+                            topMargin=0.75 * inch, bottomMargin=0.75 * inch)
+    doc.build(story)
     print(f"PDF generated: {output_filename}")
 
+# Render a single loaded invoice
+def render_invoice(invoice, css, date_str, regenerate=False, debug_mode=False, use_reportlab=False):
+    """Generate the PDF for one loaded invoice. Returns True on success.
+    
+    `invoice` is an (invoice_file, invoice_data, content_hash) tuple as
+    built by main().
+    """
+    invoice_file, invoice_data, content_hash = invoice
+    try:
+        invoice_number = invoice_data["invoice_number"]
+        output_filename = f"output/invoice_{invoice_number}_{date_str}.pdf"
+        
+        # If regenerating, note if we're overwriting
+        if regenerate and os.path.exists(output_filename):
+            print(f"Overwriting existing PDF for invoice {invoice_number}")
+        
+        if use_reportlab:
+            render_invoice_pdf(invoice_data, output_filename)
+        else:
+            # Create Markdown content and generate the PDF through WeasyPrint
+            markdown_content = create_markdown_invoice(invoice_data)
+            generate_pdf(markdown_content, output_filename, css, debug_mode=debug_mode)
+        
+        # Record which YAML contents this PDF was built from
+        with open(f"{output_filename}.blake2b", 'w') as file:
+            file.write(content_hash)
+        return True
+        
+    except Exception as e:
+        print(f"Error processing {invoice_file}: {str(e)}")
+        return False
+
 # Main function
 def main():
     """Process all invoice YAML files and generate PDFs."""
@@ -113,7 +282,11 @@ def main():
                        help='Force regeneration of PDFs even if they already exist')
     parser.add_argument('--debug', action='store_true',
                        help='Save HTML output to debug.html for browser inspection')
+    parser.add_argument('--reportlab', action='store_true',
+                       help='Draw PDFs directly with ReportLab (faster, ignores includes/style.css)')
     args = parser.parse_args()
+    if args.debug and args.reportlab:
+        parser.error("--debug inspects the HTML pipeline and cannot be combined with --reportlab")
     
     # Ensure directories exist
     os.makedirs("invoices", exist_ok=True)
@@ -133,42 +306,64 @@ def main():
         mode_info.append("REGENERATE MODE")
     if args.debug:
         mode_info.append("DEBUG MODE")
+    if args.reportlab:
+        mode_info.append("REPORTLAB MODE")
     
     if mode_info:
         print(f"Found {len(invoice_files)} invoice(s) to process ({', '.join(mode_info)})...")
     else:
         print(f"Found {len(invoice_files)} invoice(s) to process...")
     
-    processed_count = 0
-    skipped_count = 0
+    # Scan the output directory once (not needed when regenerating everything)
+    existing_pdfs = {} if args.regenerate else get_existing_pdfs()
+    
+    # Load CSS from external file once for the whole batch (unused by ReportLab)
+    css = None if args.reportlab else load_css()
+    
+    # Date-stamp every PDF in the batch with the same day
+    date_str = datetime.now().strftime('%Y%m%d')
     
+    # Load every invoice up front and drop the ones that are already up to date,
+    # so worker processes only receive (and never re-read) invoices to render
+    to_render = []
+    queued_files = {}
+    skipped_count = 0
     for invoice_file in invoice_files:
         try:
-            # Load invoice data
-            invoice_data = load_invoice_data(invoice_file)
+            invoice_data, content_hash = load_invoice_data(invoice_file)
             invoice_number = invoice_data["invoice_number"]
-            
-            # Check if PDF already exists (unless regenerating)
-            if check_existing_pdf(invoice_number, force_regenerate=args.regenerate):
-                print(f"Skipping invoice {invoice_number} - PDF already exists")
-                skipped_count += 1
-                continue
-            
-            # Create Markdown content
-            markdown_content = create_markdown_invoice(invoice_data)
-            
-            # Generate PDF
-            output_filename = f"output/invoice_{invoice_number}_{datetime.now().strftime('%Y%m%d')}.pdf"
-            
-            # If regenerating, note if we're overwriting
-            if args.regenerate and os.path.exists(output_filename):
-                print(f"Overwriting existing PDF for invoice {invoice_number}")
-            
-            generate_pdf(markdown_content, output_filename, debug_mode=args.debug)
-            processed_count += 1
-            
         except Exception as e:
             print(f"Error processing {invoice_file}: {str(e)}")
+            continue
+        
+        # Check if an up-to-date PDF already exists (unless regenerating)
+        if check_existing_pdf(invoice_number, existing_pdfs, content_hash):
+            print(f"Skipping invoice {invoice_number} - PDF already exists")
+            skipped_count += 1
+            continue
+        # Two files with the same invoice number would render the same PDF
+        # concurrently, so only the first one is queued
+        if str(invoice_number) in queued_files:
+            print(f"Skipping {invoice_file} - invoice {invoice_number} is already "
+                  f"generated from {queued_files[str(invoice_number)]}")
+            skipped_count += 1
+            continue
+        if str(invoice_number) in existing_pdfs:
+            print(f"Invoice {invoice_number} changed since its last PDF, regenerating")
+        
+        queued_files[str(invoice_number)] = invoice_file
+        to_render.append((invoice_file, invoice_data, content_hash))
+    
+    # Invoices are independent, so render them across worker processes.
+    # Debug mode stays sequential so debug.html isn't written concurrently.
+    processed_count = 0
+    if to_render:
+        max_workers = 1 if args.debug else min(len(to_render), os.cpu_count() or 1)
+        worker = functools.partial(render_invoice, css=css, date_str=date_str,
+                                   regenerate=args.regenerate, debug_mode=args.debug,
+                                   use_reportlab=args.reportlab)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            processed_count = sum(executor.map(worker, to_render))
     
     print(f"\nProcessing complete!")
     print(f"Generated: {processed_count} invoice(s)")